@@ -1,9 +1,25 @@
 import argparse
+import asyncio
+import base64
+import csv
+import hashlib
+import io
+import itertools
+import operator
 import os
 from dataclasses import dataclass
 
+import aiohttp
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase
 from sonarqube import SonarQubeClient
-from sonarqube.utils.exceptions import AuthError
+from urllib3.util.retry import Retry
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 """
 Measures Lines of Code (LOC) in SonarQube.  
@@ -17,6 +33,7 @@ Hence, it is helpful to control the license limits of a SonarQube instance.
 
 How:
 The SonarQube REST API is queried to extract the size of each branch of every project in the SonarQube instance.
+The requests for all projects and branches are sent concurrently, as the analysis is dominated by network latency.
 
 Features:
 * Write each branch name and its number analyzed lines of code of a project to a CSV file.      
@@ -24,6 +41,11 @@ Features:
   the size reported by SonarQube in the license overview page in the administration section.
 * Print the largest files of a branch of a project.
 
+Caching:
+The responses used for the branch size and the total size are cached on disk for an hour in the file
+sonarqube_cache.sqlite, which speeds up repeated runs. The cache is specific to the token and the version of the
+SonarQube instance. Pass the option --no-cache to always query the SonarQube instance.
+
   
 Authentication:
 Authentication to the SonarQube instance is done via a token with admin privileges.
@@ -38,143 +60,308 @@ For usage information, call the script with the "--help" option.
 """
 
 
-@dataclass
+def _get_token_from_environment_variables():
+    """ Retrieve the token from environment variables """
+    token = os.getenv("SONARQUBE_ADMIN_TOKEN")
+    return token
+
+
+def _create_authorization_headers(token: str):
+    """ Create the headers to authenticate with a token, which are built once and sent with every request """
+    if not token:
+        return {}
+    credentials = base64.b64encode(f"{token}:".encode()).decode()
+    return {"Authorization": f"Basic {credentials}"}
+
+
+class _NamespacedSQLiteBackend(SQLiteBackend):
+    """ SQLite cache whose keys additionally depend on a namespace, which can be set after the session is created """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.namespace = ""
+
+    def create_key(self, method: str, url, **kwargs):
+        return f"{self.namespace}-{super().create_key(method, url, **kwargs)}"
+
+
+class _HeaderAuth(AuthBase):
+    """ Authenticate requests with prebuilt headers, taking precedence over credentials from ~/.netrc """
+
+    def __init__(self, headers: dict[str, str]):
+        self._headers = headers
+
+    def __call__(self, request):
+        request.headers.update(self._headers)
+        return request
+
+
+@dataclass(slots=True, frozen=True)
 class Result:
     """ DTO to represent results for an element that has a number of lines """
     number_of_lines: int
     identifier: str
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class BranchResult(Result):
     """ DTO to represent results for an element in a branch """
     branch_name: str
 
 
+@dataclass(slots=True, frozen=True)
+class Branch:
+    """ DTO to represent a branch of a project """
+    name: str
+    is_main: bool
+
+
 class SonarQubeFacade:
     """ Access SonarQube API """
 
+    POOL_CONNECTIONS = 16
+    POOL_MAX_SIZE = 64
+    TIMEOUT_SECONDS = 30
+
     def __init__(self, url: str, token: str = ""):
         """
         :parameter url: The address to the sonarQube instance.
         :parameter token A token with admin privileges.
         """
         self.sonarqube_url = url
-        self._token = token if token else self._get_token_from_environment_variables()
+        self._token = token if token else _get_token_from_environment_variables()
         self._client = self._create_client()
 
-    def _get_token_from_environment_variables(self):
-        """ Retrieve the token from environment variables """
-        token = os.getenv("SONARQUBE_ADMIN_TOKEN")
-        return token
-
     def _create_client(self):
         """ Create a SonarQube client """
-        return SonarQubeClient(sonarqube_url=self.sonarqube_url, token=self._token)
+        client = SonarQubeClient(sonarqube_url=self.sonarqube_url, token=self._token, timeout=self.TIMEOUT_SECONDS)
+        self._mount_pooling_adapter(client.session)
+        self._set_authorization_headers(client.session)
+        return client
+
+    def _set_authorization_headers(self, session):
+        """ Authenticate with a fixed header instead of building it for every request """
+        if self._token:
+            session.auth = _HeaderAuth(_create_authorization_headers(self._token))
+
+    def _mount_pooling_adapter(self, session):
+        """ Reuse connections of the session and retry failed connections with backoff """
+        adapter = HTTPAdapter(pool_connections=self.POOL_CONNECTIONS, pool_maxsize=self.POOL_MAX_SIZE,
+                              max_retries=Retry(total=3, backoff_factor=0.3))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def get_file_sizes(self, project_key: str, branch_name: str, limit: int | None = None):
+        """
+        Retrieve the file paths and number of lines of a branch for a given project, largest files first.
+        :parameter limit: The maximal number of files. Only the pages of the component tree needed for them are fetched.
+        """
+        component_tree = self._client.measures.get_component_tree_with_specified_measures(component=project_key,
+                                                                                         branch=branch_name,
+                                                                                         metricKeys="ncloc",
+                                                                                         strategy="leaves",
+                                                                                         metricSort="ncloc",
+                                                                                         asc="false",
+                                                                                         s="metric")
+        return list(itertools.islice(self._get_file_results(component_tree), limit))
+
+    @staticmethod
+    def _get_file_results(component_tree):
+        """ Convert the components of a component tree to results, skipping components without measure """
+        for component in component_tree:
+            try:
+                yield Result(identifier=component["path"], number_of_lines=int(component["measures"][0]["value"]))
+            except IndexError:
+                print(f"Failed to process {component['key']}")
+
+
+class AsyncSonarQubeFacade:
+    """
+    Access SonarQube API asynchronously, so that many projects and branches can be queried concurrently.
+    The native SonarQube endpoints are called directly, because the sonarqube client only supports blocking calls.
+    Use as async context manager to open and close the underlying connection pool.
+    Responses are cached on disk if enabled, only reused for the same token and version of the SonarQube instance.
+    """
 
-    def get_project_keys(self):
+    CACHE_NAME = "sonarqube_cache"
+    CACHE_EXPIRE_AFTER_SECONDS = 3600
+    MAX_CONNECTIONS = 64
+    DNS_CACHE_SECONDS = 300
+    PAGE_SIZE = 500
+    MAX_PROJECT_KEYS_PER_SEARCH = 100
+
+    def __init__(self, url: str, token: str = "", use_cache: bool = True):
+        """
+        :parameter url: The address to the sonarQube instance.
+        :parameter token A token with admin privileges.
+        :parameter use_cache Whether responses are cached on disk.
+        """
+        self.sonarqube_url = url
+        self._token = token if token else _get_token_from_environment_variables()
+        self._use_cache = use_cache
+        self._client = None
+
+    async def __aenter__(self):
+        self._client = self._create_client()
+        if self._use_cache:
+            self._client.cache.namespace = await self._get_cache_namespace()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._client.close()
+        self._client = None
+
+    def _create_client(self):
+        """ Create an HTTP session sharing a bounded pool of keep-alive connections, caching responses if enabled """
+        # Requests wait for a free connection without timeout, as all branches are queued at once.
+        session_arguments = dict(headers=_create_authorization_headers(self._token),
+                                 connector=aiohttp.TCPConnector(limit=self.MAX_CONNECTIONS,
+                                                                ttl_dns_cache=self.DNS_CACHE_SECONDS),
+                                 timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30),
+                                 raise_for_status=True)
+        if not self._use_cache:
+            return aiohttp.ClientSession(**session_arguments)
+        cache = _NamespacedSQLiteBackend(cache_name=self.CACHE_NAME, expire_after=self.CACHE_EXPIRE_AFTER_SECONDS)
+        return CachedSession(cache=cache, **session_arguments)
+
+    async def _get_cache_namespace(self):
+        """ Derive the namespace of cached responses from the token and the version of the SonarQube instance """
+        async with self._client.disabled():
+            async with self._client.get(f"{self.sonarqube_url.rstrip('/')}/api/server/version") as response:
+                server_version = await response.text()
+        return hashlib.sha256(f"{self._token}:{server_version}".encode()).hexdigest()[:16]
+
+    async def _get(self, path: str, **params):
+        """ Send a GET request to the SonarQube API and return the decoded JSON response """
+        async with self._client.get(f"{self.sonarqube_url.rstrip('/')}{path}", params=params) as response:
+            return await response.json()
+
+    async def get_project_keys(self):
         """ List the keys of all projects """
-        return_object = list(self._client.projects.search_projects())
-        return [project["key"] for project in return_object]
-
-    def get_project_size(self, project_key: str):
-        """ The the number of lines of code for a specific project """
-        component = self._client.measures.get_component_with_specified_measures(component=project_key,
-                                                                                metricKeys="ncloc")
-        measures = component["component"]["measures"]
-        return measures[0]["value"] if len(measures) > 0 else 0
-
-    def get_branches(self, project_key: str):
-        """ Retrieve the name of the branches of a project """
-        branches = self._client.project_branches.search_project_branches(project=project_key)
-        branch_names = [branch["name"] for branch in branches["branches"]]
-        return branch_names
-
-    def get_branch_size(self, project_key: str, branch_name: str):
+        project_keys = []
+        page = 1
+        while True:
+            result = await self._get("/api/projects/search", p=page, ps=self.PAGE_SIZE)
+            project_keys.extend(project["key"] for project in result["components"])
+            if len(project_keys) >= result["paging"]["total"] or not result["components"]:
+                return project_keys
+            page += 1
+
+    async def get_project_sizes_bulk(self, project_keys: list[str]) -> dict[str, int]:
+        """
+        Retrieve the number of lines of the main branch of many projects with as few requests as possible.
+        Projects without measure are missing in the returned mapping of project key to number of lines.
+        """
+        chunks = [project_keys[start:start + self.MAX_PROJECT_KEYS_PER_SEARCH]
+                  for start in range(0, len(project_keys), self.MAX_PROJECT_KEYS_PER_SEARCH)]
+        results = await asyncio.gather(
+            *[self._get("/api/measures/search", projectKeys=",".join(chunk), metricKeys="ncloc") for chunk in chunks])
+        return {measure["component"]: int(measure["value"]) for result in results for measure in result["measures"]}
+
+    async def get_branches(self, project_key: str):
+        """ Retrieve the branches of a project """
+        result = await self._get("/api/project_branches/list", project=project_key)
+        return [Branch(name=branch["name"], is_main=branch["isMain"]) for branch in result["branches"]]
+
+    async def get_branch_size(self, project_key: str, branch_name: str) -> int:
         """ Retrieve the number of lines of a branch of a given project """
         result = 0
         try:
-            component = self._client.measures.get_component_with_specified_measures(component=project_key,
-                                                                                branch=branch_name,
-                                                                                metricKeys="ncloc")
+            component = await self._get("/api/measures/component", component=project_key, branch=branch_name,
+                                        metricKeys="ncloc")
             measures = component["component"]["measures"]
-            result = measures[0]["value"] if len(measures) > 0 else 0
-        except AuthError:
+            result = int(measures[0]["value"]) if measures else 0
+        except aiohttp.ClientResponseError as error:
+            if error.status not in (401, 403):
+                raise
             print(f"Could not check project {project_key}, not sufficient privileges")
         return result
 
-    def get_file_sizes(self, project_key: str, branch_name: str):
-        """ Retrieve the file paths and number of lines of a branch for a given project """
-        component_tree = list(
-            self._client.measures.get_component_tree_with_specified_measures(component=project_key,
-                                                                             branch=branch_name,
-                                                                             metricKeys="ncloc",
-                                                                             strategy="leaves",
-                                                                             metricSort="ncloc",
-                                                                             asc="false",
-                                                                             s="metric"))
-
-        results = []
-        for component in component_tree:
-            try:
-                results.append(Result(identifier=component["path"], number_of_lines=component["measures"][0]["value"]))
-            except IndexError:
-                print(f"Failed to process {component['key']}")
-        return results
-
 
 class SonarQubeNumberOfLinesAnalysis:
     """ Analyze the number of lines in SonarQube """
 
     REPORT_FILE_PATH = "branch_size_report.csv"
 
-    def __init__(self, client: SonarQubeFacade):
+    def __init__(self, client: SonarQubeFacade, async_client: AsyncSonarQubeFacade):
         self.client = client
+        self.async_client = async_client
+        self._branch_sizes = None
 
-    def get_branch_size_report(self):
+    async def _collect_branch_sizes(self):
+        """
+        Retrieve the number of lines of code of all branches of all projects concurrently, as mapping of project key
+        to a mapping of branch name to number of lines. The result is collected once and shared by all reports.
+        The main branches are measured in bulk, only the other branches and main branches missing in the bulk result
+        require a request each.
+        """
+        if self._branch_sizes is not None:
+            return self._branch_sizes
+        project_keys = await self.async_client.get_project_keys()
+        branch_lists, main_branch_sizes = await asyncio.gather(
+            asyncio.gather(*[self.async_client.get_branches(project_key=project) for project in project_keys]),
+            self.async_client.get_project_sizes_bulk(project_keys))
+        # Projects the token may not browse are missing in the bulk result, measure them separately to report them.
+        single_branches = [(project, branch.name) for project, branches in zip(project_keys, branch_lists)
+                           for branch in branches if not branch.is_main or project not in main_branch_sizes]
+        single_branch_sizes = await asyncio.gather(
+            *[self.async_client.get_branch_size(project_key=project, branch_name=branch)
+              for project, branch in single_branches])
+        single_branch_sizes = dict(zip(single_branches, single_branch_sizes))
+        self._branch_sizes = {
+            project: {branch.name: single_branch_sizes.get((project, branch.name), main_branch_sizes.get(project))
+                      for branch in branches}
+            for project, branches in zip(project_keys, branch_lists)}
+        return self._branch_sizes
+
+    async def _get_branch_results(self):
+        """ Retrieve the number of lines of code of all branches of all projects """
+        branch_sizes = await self._collect_branch_sizes()
+        return [BranchResult(identifier=project, branch_name=branch, number_of_lines=number_of_lines)
+                for project, project_branch_sizes in branch_sizes.items()
+                for branch, number_of_lines in project_branch_sizes.items()]
+
+    @staticmethod
+    def _write_branch_size_report(file, branch_results: list[BranchResult]):
+        """ Write the branch results as CSV to a file object, sorted by the number of lines of code """
+        writer = csv.writer(file)
+        writer.writerow(["Project", "Branch", "Number of lines of code"])
+        writer.writerows((result.identifier, result.branch_name, result.number_of_lines)
+                         for result in sorted(branch_results, key=operator.attrgetter("number_of_lines"), reverse=True))
+
+    async def get_branch_size_report(self):
         """ Create a report including the name of project, name of branch and the number of lines of code """
-        project_keys = self.client.get_project_keys()
-        branch_results = []
-        for project in project_keys:
-            branches = self.client.get_branches(project_key=project)
-            for branch in branches:
-                code_lines = self.client.get_branch_size(project_key=project, branch_name=branch)
-                branch_results.append(
-                    BranchResult(identifier=project, branch_name=branch, number_of_lines=int(code_lines)))
-        report_string = "Project, Branch, Number of lines of code\n"
-        for result in sorted(branch_results, key=lambda x: x.number_of_lines, reverse=True):
-            report_string += f"{result.identifier}, {result.branch_name}, {result.number_of_lines}\n"
-
-        return report_string
-
-    def print_in_console_branch_size_report(self):
+        branch_results = await self._get_branch_results()
+        report = io.StringIO()
+        self._write_branch_size_report(report, branch_results)
+        return report.getvalue()
+
+    async def print_in_console_branch_size_report(self):
         """ Print the report of branch size to the console """
-        report = self.get_branch_size_report()
+        report = await self.get_branch_size_report()
         print(report)
 
-    def print_in_file_branch_size_report(self):
+    async def print_in_file_branch_size_report(self):
         """ Print the report of branch size to a file """
-        report = self.get_branch_size_report()
-        with open(self.REPORT_FILE_PATH, "w") as file:
-            file.write(report)
+        branch_results = await self._get_branch_results()
+        await asyncio.to_thread(self._write_branch_size_report_file, branch_results)
         print(f"Report written to file {self.REPORT_FILE_PATH}")
 
-    def get_total_size(self):
+    def _write_branch_size_report_file(self, branch_results: list[BranchResult]):
+        """ Write the branch results to the report file, blocking on disk I/O """
+        with open(self.REPORT_FILE_PATH, "w", newline="") as file:
+            self._write_branch_size_report(file, branch_results)
+
+    async def get_total_size(self):
         """ Get the total number of lines of code """
-        project_keys = self.client.get_project_keys()
-        total = 0
-        for project in project_keys:
-            branches = self.client.get_branches(project_key=project)
-            number_of_lines = [int(self.client.get_branch_size(project_key=project, branch_name=branch)) for branch in
-                               branches]
-            total += max(number_of_lines)
-        return total
+        branch_sizes = await self._collect_branch_sizes()
+        return sum(max(project_branch_sizes.values(), default=0) for project_branch_sizes in branch_sizes.values())
 
     def get_top_x_files_report(self, project_key: str, branch_name: str, top_x=10):
         """ Retrieve the top x files of a branch """
-        file_sizes = self.client.get_file_sizes(project_key=project_key, branch_name=branch_name)
+        file_sizes = self.client.get_file_sizes(project_key=project_key, branch_name=branch_name, limit=top_x)
         report = "Project, Branch, Path, Number of lines of code\n"
-        for file_size in file_sizes[:top_x]:
+        for file_size in file_sizes:
             report += f"{project_key}, {branch_name}, {file_size.identifier}, {file_size.number_of_lines}\n"
         return report
 
@@ -198,36 +385,55 @@ def main():
     parser.add_argument("--sonarqube-admin-token", action="store", default="",
                         help="Token with admin privileges. If no token is passed via command line, "
                              "the script reads the environment variable SONARQUBE_ADMIN_TOKEN.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not cache responses of the SonarQube instance for the branch size and the total size"
+                             " on disk.")
     parser.add_argument("--sonarqube-url", action="store", default="https://www.ci-d-fine.de:9000",
                         help="The address of the SonarQube instance.")
     args = parser.parse_args()
 
-    analysis = _create_analysis(args.sonarqube_url, args.sonarqube_admin_token)
+    analysis = _create_analysis(args.sonarqube_url, args.sonarqube_admin_token, use_cache=not args.no_cache)
 
-    if args.branch_size:
-        branch_size_analysis(analysis)
-    if args.total_size:
-        get_total_size(analysis)
+    if args.branch_size or args.total_size:
+        _run_event_loop(_run_branch_analyses(analysis, branch_size=args.branch_size, total_size=args.total_size))
     if args.top_x_files:
         project_key, branch_name, top_x = args.top_x_files.split(",")
         get_top_x(project_key=project_key, branch_name=branch_name, top_x=int(top_x), analysis=analysis)
 
 
-def _create_analysis(sonarqube_url: str, sonarqube_token: str):
+def _create_analysis(sonarqube_url: str, sonarqube_token: str, use_cache: bool = True):
     """ Prepare the analysis object """
+    sonarqube_token = sonarqube_token if sonarqube_token else _get_token_from_environment_variables()
     client = SonarQubeFacade(url=sonarqube_url, token=sonarqube_token)
-    analysis = SonarQubeNumberOfLinesAnalysis(client=client)
+    async_client = AsyncSonarQubeFacade(url=sonarqube_url, token=sonarqube_token, use_cache=use_cache)
+    analysis = SonarQubeNumberOfLinesAnalysis(client=client, async_client=async_client)
     return analysis
 
 
-def branch_size_analysis(analysis: SonarQubeNumberOfLinesAnalysis):
+def _run_event_loop(coroutine):
+    """ Run a coroutine on uvloop if available, which reduces the overhead of the event loop for many requests """
+    if uvloop is None:
+        return asyncio.run(coroutine)
+    return uvloop.run(coroutine)
+
+
+async def _run_branch_analyses(analysis: SonarQubeNumberOfLinesAnalysis, branch_size: bool, total_size: bool):
+    """ Execute the analyses which query all branches of all projects """
+    async with analysis.async_client:
+        if branch_size:
+            await branch_size_analysis(analysis)
+        if total_size:
+            await get_total_size(analysis)
+
+
+async def branch_size_analysis(analysis: SonarQubeNumberOfLinesAnalysis):
     """ Execute the branch size analysis """
-    analysis.print_in_file_branch_size_report()
+    await analysis.print_in_file_branch_size_report()
 
 
-def get_total_size(analysis: SonarQubeNumberOfLinesAnalysis):
+async def get_total_size(analysis: SonarQubeNumberOfLinesAnalysis):
     """ Print the total size """
-    print(f"Total number of lines: {analysis.get_total_size()}")
+    print(f"Total number of lines: {await analysis.get_total_size()}")
 
 
 def get_top_x(project_key: str, branch_name: str, top_x: int, analysis: SonarQubeNumberOfLinesAnalysis):